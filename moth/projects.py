@@ -1,13 +1,17 @@
 """ This module can be used for tiling in a QuPathProjects without leaving Python. """
 
+import os
 import pathlib
 import platform
-from collections.abc import Iterable
+from collections import OrderedDict
+from collections.abc import Iterable, Iterator
+from dataclasses import dataclass
 from textwrap import dedent
-from typing import Any, Literal, NamedTuple, Optional, Union, cast, overload
+from typing import Any, Literal, NamedTuple, Optional, Union, overload
 
 import numpy as np
 import rasterio.features
+import shapely
 from numpy.typing import NDArray
 from paquo.classes import QuPathPathClass
 from paquo.hierarchy import PathObjectProxy, QuPathPathObjectHierarchy
@@ -15,14 +19,69 @@ from paquo.images import QuPathProjectImageEntry
 from paquo.pathobjects import QuPathPathAnnotationObject
 from paquo.projects import ProjectIOMode, QuPathProject
 from PIL.Image import Image
-from shapely import affinity
-from shapely.geometry import GeometryCollection, MultiPolygon, Polygon, shape
-from shapely.geometry.base import BaseGeometry, BaseMultipartGeometry
-from shapely.ops import unary_union
+from shapely.geometry import Polygon, shape
+from shapely.geometry.base import BaseGeometry
 from shapely.strtree import STRtree
 from tiffslide import TiffSlide
 
 
+# mean bounding box area (in pixels) per polygon up to which
+# testing pixel centers is faster than rasterio.features.rasterize
+POINT_TEST_MAX_AREA_PER_POLYGON: int = 256
+
+# number of slides kept open by a project, the least recently used slide is closed
+MAX_OPEN_SLIDES: int = 16
+
+# CUDA kernel for the 'cuda' mask backend, one thread per pixel
+# polygons are tested in drawing order with the even-odd rule
+FILL_POLYGONS_CUDA_SOURCE: str = r"""
+extern "C" __global__ void fill_polygons(
+    const double* coords,
+    const int* ring_offsets,
+    const int* polygon_offsets,
+    const double* bounds,
+    const int* layers,
+    const int* values,
+    const int num_polygons,
+    const int height,
+    const int width,
+    int* mask)
+{
+    const int pixel = blockDim.x * blockIdx.x + threadIdx.x;
+    if (pixel >= height * width) {
+        return;
+    }
+    const double px = (pixel % width) + 0.5;
+    const double py = (pixel / width) + 0.5;
+
+    for (int p = 0; p < num_polygons; ++p) {
+        if (px < bounds[4 * p] || py < bounds[4 * p + 1]
+            || px > bounds[4 * p + 2] || py > bounds[4 * p + 3]) {
+            continue;
+        }
+        bool inside = false;
+        for (int r = polygon_offsets[p]; r < polygon_offsets[p + 1]; ++r) {
+            // rings are closed, the last coordinate equals the first one
+            for (int i = ring_offsets[r]; i < ring_offsets[r + 1] - 1; ++i) {
+                const double x0 = coords[2 * i];
+                const double y0 = coords[2 * i + 1];
+                const double x1 = coords[2 * i + 2];
+                const double y1 = coords[2 * i + 3];
+                if (((y0 > py) != (y1 > py))
+                    && (px < (x1 - x0) * (py - y0) / (y1 - y0) + x0)) {
+                    inside = !inside;
+                }
+            }
+        }
+        if (inside) {
+            mask[(long long)layers[p] * height * width + pixel] = values[p];
+        }
+    }
+}
+"""
+_FILL_POLYGONS_KERNEL: Any = None  # compiled on first use of the 'cuda' backend
+
+
 class MaskParameter(NamedTuple):
     """Parameter for mask generation and saving
 
@@ -50,6 +109,28 @@ class MaskParameter(NamedTuple):
     downsample_level_power_of: Optional[int] = None
 
 
+@dataclass
+class _AnnotationCache:
+    """Annotations of one image as parallel arrays
+
+    Attributes
+    ----------
+    geoms : NDArray[np.object_]
+        Annotation rois in hierarchy order
+    classes : NDArray[np.object_]
+        Annotation class id of each roi, "Unknown" for rois without a class
+    areas : NDArray[np.float64]
+        Area of each roi with filled holes
+    tree : STRtree
+        Query tree over geoms, query results index the arrays above
+    """
+
+    geoms: NDArray[np.object_]
+    classes: NDArray[np.object_]
+    areas: NDArray[np.float64]
+    tree: STRtree
+
+
 class QuPathTilingProject(QuPathProject):
     """Load or create a new QuPath project
 
@@ -75,15 +156,35 @@ class QuPathTilingProject(QuPathProject):
         self._inverse_class_dict = {
             value.id: key for key, value in self._class_dict.items()
         }
+        # translates an array of class ids to class numbers in one call
+        self._translate_classes: np.ufunc = np.frompyfunc(
+            self._inverse_class_dict.get, 2, 1
+        )
 
-        ## create dictionary to hold one STRtree per image
-        # {img_id: (annotationTree, {roi_id: (annotation_id, path_class)})}
+        ## create dictionary to hold the annotation arrays of each image
+        # {img_id: _AnnotationCache}
         # each image has an own query tree
-        # roi's in the tree are identified by their id
-        # each roi_id has it's own enumerated annotation_id and path_class
-        self.img_annotation_dict: dict[
-            int, tuple[STRtree, dict[int, tuple[int, str]]]
-        ] = {}
+        # tree indices returned by a query are the annotation_ids,
+        # which index the roi, path_class and area arrays
+        self.img_annotation_dict: dict[int, _AnnotationCache] = {}
+
+        ## opened slides are kept to avoid reopening them for every tile
+        # {img_id: (slide_url, slide)} ordered from least to most recently used
+        self._slide_handles: OrderedDict[int, tuple[str, TiffSlide]] = OrderedDict()
+        # process which opened the slides, forked processes
+        # (e.g. DataLoader workers) must not share the file handles
+        self._slide_handles_pid: int = os.getpid()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        super().__exit__(exc_type, exc_val, exc_tb)
+
+    def close(self) -> None:
+        """Close all slides opened for tiling"""
+        slide_data: TiffSlide
+        for _, slide_data in self._slide_handles.values():
+            slide_data.close()
+        self._slide_handles = OrderedDict()
 
     @QuPathProject.path_classes.setter
     def path_classes(self, path_classes: Iterable[QuPathPathClass]) -> None:
@@ -101,6 +202,10 @@ class QuPathTilingProject(QuPathProject):
         self._inverse_class_dict = {
             value.id: key for key, value in self._class_dict.items()
         }
+        # translates an array of class ids to class numbers in one call
+        self._translate_classes: np.ufunc = np.frompyfunc(
+            self._inverse_class_dict.get, 2, 1
+        )
 
     def _update_img_annotation_dict(self, img_id: int) -> None:
         """Update annotation roi tree for faster shapely queries
@@ -121,15 +226,30 @@ class QuPathTilingProject(QuPathProject):
             for annotation in annotations
         ]
 
-        # list[tuple[Polygon, str]] -> NDArray[list(roi, list(annotation_classes)]
-        img_ann_transposed: NDArray = np.array(img_ann_list, dtype=object).transpose()
-        ## generate dict to map roi_id to tuple(annotation_id, annotation_class)
-        class_by_id: dict[int, tuple[int, str]] = dict(
-            (id(ann_poly), (i, img_ann_transposed[1][i]))
-            for i, ann_poly in enumerate(img_ann_transposed[0])
+        # list[tuple[Polygon, str]] -> tuple[rois], tuple[annotation_classes]
+        img_ann_rois: tuple[Polygon, ...]
+        img_ann_classes: tuple[str, ...]
+        img_ann_rois, img_ann_classes = (
+            tuple(zip(*img_ann_list)) if img_ann_list else ((), ())
+        )
+        img_ann_geoms: NDArray[np.object_] = np.asarray(img_ann_rois, dtype=object)
+
+        ## area of each roi with filled holes, summed over the parts of multipolygons
+        # holes must not make an annotation smaller than the annotations inside it
+        ann_parts: NDArray[np.object_]
+        ann_part_index: NDArray[np.intp]
+        ann_parts, ann_part_index = shapely.get_parts(img_ann_geoms, return_index=True)
+        filled_part_areas: NDArray[np.float64] = shapely.area(
+            shapely.polygons(shapely.get_exterior_ring(ann_parts))
+        )
+        self.img_annotation_dict[img_id] = _AnnotationCache(
+            geoms=img_ann_geoms,
+            classes=np.asarray(img_ann_classes, dtype=object),
+            areas=np.bincount(
+                ann_part_index, weights=filled_part_areas, minlength=len(img_ann_geoms)
+            ),
+            tree=STRtree(img_ann_geoms),
         )
-        img_ann_tree: STRtree = STRtree(img_ann_transposed[0])
-        self.img_annotation_dict[img_id] = (img_ann_tree, class_by_id)
 
     @overload
     def get_tile(
@@ -183,16 +303,77 @@ class QuPathTilingProject(QuPathProject):
         Union[Image, NDArray[np.int_]]
             Requested tile as PIL Image
         """
-        slide: QuPathProjectImageEntry = self.images[img_id]
-        slide_url: str = self._prepare_image_url(slide)
+        slide_data: TiffSlide = self._get_slide(img_id)
         # get requested tile
-        with TiffSlide(slide_url) as slide_data:
-            # if an array is requested, return array
-            if ret_array:
-                return slide_data.read_region(
-                    location, downsample_level, size, as_array=True
-                )
-            return slide_data.read_region(location, downsample_level, size)
+        # if an array is requested, return array
+        if ret_array:
+            return slide_data.read_region(
+                location, downsample_level, size, as_array=True
+            )
+        return slide_data.read_region(location, downsample_level, size)
+
+    def iter_tile_locations_z_order(
+        self,
+        img_id: int,
+        size: tuple[int, int],
+        downsample_level: int = 0,
+    ) -> Iterator[tuple[int, int]]:
+        """Iterate over the tile locations of an image in Morton (Z-)order
+
+        Consecutive tiles are spatially adjacent,
+        so successive get_tile calls reuse the slide's cached image tiles.
+
+        Parameters
+        ----------
+        img_id : int
+            Id of image to tile
+        size : tuple[int, int]
+            (width, height) for the tile
+        downsample_level : int, optional
+            Level for downsampling, by default 0
+
+        Yields
+        ------
+        Iterator[tuple[int, int]]
+            (x, y) coordinates for the top left pixel of each tile \n
+            pixel location without downsampling
+        """
+        slide: QuPathProjectImageEntry = self.images[img_id]
+        downsample_factor: float = self.get_downsample_factor(
+            downsample_level, img_id=img_id
+        )
+        # tile size on slide level 0
+        step_x: int = round(size[0] * downsample_factor)
+        step_y: int = round(size[1] * downsample_factor)
+        tiles_x: int = -(-slide.width // step_x)
+        tiles_y: int = -(-slide.height // step_y)
+
+        tile_y: NDArray[np.uint64]
+        tile_x: NDArray[np.uint64]
+        tile_y, tile_x = np.indices((tiles_y, tiles_x), dtype=np.uint64).reshape(2, -1)
+
+        ## interleave the bits of the tile indices to get their Morton codes
+        # spread the lower 32 bits of each index to every second bit
+        spread_steps: tuple[tuple[int, int], ...] = (
+            (16, 0x0000FFFF0000FFFF),
+            (8, 0x00FF00FF00FF00FF),
+            (4, 0x0F0F0F0F0F0F0F0F),
+            (2, 0x3333333333333333),
+            (1, 0x5555555555555555),
+        )
+        morton_code: NDArray[np.uint64] = np.zeros_like(tile_x)
+        tile_index: NDArray[np.uint64]
+        for shift, tile_index in enumerate((tile_x, tile_y)):
+            spread: NDArray[np.uint64] = tile_index & np.uint64(0xFFFFFFFF)
+            for bits, bit_mask in spread_steps:
+                spread = (spread | (spread << np.uint64(bits))) & np.uint64(bit_mask)
+            morton_code |= spread << np.uint64(shift)
+
+        z_order: NDArray[np.intp] = np.argsort(morton_code, kind="stable")
+        x: int
+        y: int
+        for x, y in zip(tile_x[z_order].tolist(), tile_y[z_order].tolist()):
+            yield x * step_x, y * step_y
 
     def get_tile_annotation(
         self,
@@ -221,57 +402,129 @@ class QuPathTilingProject(QuPathProject):
             List of annotations (polygon, annotation_class) in tile
         """
 
-        polygon_tile: Polygon = Polygon(
+        tile_polys: NDArray[np.object_]
+        tile_classes: NDArray[np.object_]
+        tile_polys, tile_classes, _ = self._get_tile_intersections(
+            img_id, location, size, class_filter
+        )
+        tile_intersections: list[tuple[Polygon, str]] = list(
+            zip(tile_polys.tolist(), tile_classes.tolist())
+        )
+
+        return tile_intersections
+
+    def _get_tile_intersections(
+        self,
+        img_id: int,
+        location: tuple[int, int],
+        size: tuple[float, float],
+        class_filter: Optional[list[Union[int, str]]] = None,
+        *,
+        clip_by_rect: bool = False,
+    ) -> tuple[NDArray[np.object_], NDArray[np.object_], NDArray[np.intp]]:
+        """Get the intersections of the annotations with a tile as arrays
+
+        Parameters
+        ----------
+        img_id : int
+            Id of image from which the tile annotations will be extracted
+        location : tuple[int, int]
+            (x, y) coordinates for the top left pixel in the tile \n
+            pixel location without downsampling
+        size : tuple[float, float]
+            (width, height) for the tile, without downsampling
+        class_filter : Optional[list[Union[int, str]]], optional
+            List of annotation class names or id's to filter by
+        clip_by_rect : bool, optional
+            True: clip with the fast rectangle clipping of shapely.clip_by_rect,
+            the clipped polygons are not guaranteed to be valid
+            False: use shapely.intersection,
+            by default False
+
+        Returns
+        -------
+        tuple[NDArray[np.object_], NDArray[np.object_], NDArray[np.intp]]
+            intersection polygons, their annotation classes
+            and the annotation index of each polygon in img_annotation_dict
+        """
+
+        tile_bounds: NDArray[np.float64] = np.array(
             (
-                [location[0], location[1]],
-                [location[0] + size[0], location[1]],
-                [location[0] + size[0], location[1] + size[1]],
-                [location[0], location[1] + size[1]],
-            )
+                location[0],
+                location[1],
+                location[0] + size[0],
+                location[1] + size[1],
+            ),
+            dtype=np.float64,
         )
-        tile_intersections: list[tuple[Polygon, str]] = []
+        polygon_tile: Polygon = shapely.box(*tile_bounds)
 
         if img_id not in self.img_annotation_dict:
             self._update_img_annotation_dict(img_id)
 
-        ann_tree: STRtree
-        index_and_class: dict[int, tuple[int, str]]
-        ann_tree, index_and_class = self.img_annotation_dict[img_id]
-        near_polys: Iterable[BaseGeometry] = ann_tree.geometries.take(
-            ann_tree.query(polygon_tile)
+        ann_cache: _AnnotationCache = self.img_annotation_dict[img_id]
+        # only polygons which intersect the tile, not just its bounding box
+        near_index: NDArray[np.intp] = ann_cache.tree.query(
+            polygon_tile, predicate="intersects"
         )
-        near_poly_classes: list[str] = [
-            index_and_class[id(poly)][1] for poly in near_polys
-        ]
-
-        poly: BaseGeometry
-        annotation_class: str
-        ## check if detected polygons intersect with tile and save intersections
-        for poly, annotation_class in zip(near_polys, near_poly_classes):
-            intersection: BaseGeometry = poly.intersection(polygon_tile)
-            if intersection.is_empty:
-                continue
-
-            filter_bool: bool = (
-                (not class_filter)
-                or (annotation_class in class_filter)
-                or (self._inverse_class_dict[annotation_class] in class_filter)
+        near_polys: NDArray[np.object_] = ann_cache.geoms[near_index]
+        near_poly_classes: NDArray[np.object_] = ann_cache.classes[near_index]
+
+        ## filter detected polygons by their annotation class
+        if class_filter:
+            # class numbers are translated to class names, so an int never
+            # matches a class name that looks like a number
+            filter_classes: set[str] = {
+                filter_class
+                for filter_class in class_filter
+                if isinstance(filter_class, str)
+            }
+            filter_classes.update(
+                self._class_dict[filter_class].id
+                for filter_class in class_filter
+                if not isinstance(filter_class, str)
+                and filter_class in self._class_dict
             )
+            filter_mask: NDArray[np.bool_] = np.isin(
+                near_poly_classes, np.array(list(filter_classes), dtype=object)
+            )
+            near_index = near_index[filter_mask]
+            near_polys = near_polys[filter_mask]
+            near_poly_classes = near_poly_classes[filter_mask]
+
+        ## intersect all detected polygons with the tile at once
+        # polygons with a bounding box inside the tile are completely inside
+        # the tile and don't need to be intersected
+        near_bounds: NDArray[np.float64] = shapely.bounds(near_polys)
+        inside_tile: NDArray[np.bool_] = np.all(
+            near_bounds[:, :2] >= tile_bounds[:2], axis=1
+        ) & np.all(near_bounds[:, 2:] <= tile_bounds[2:], axis=1)
+        intersections: NDArray[np.object_] = near_polys.copy()
+        if clip_by_rect:
+            intersections[~inside_tile] = shapely.clip_by_rect(
+                near_polys[~inside_tile], *tile_bounds
+            )
+        else:
+            intersections[~inside_tile] = shapely.intersection(
+                near_polys[~inside_tile], polygon_tile
+            )
+        not_empty: NDArray[np.bool_] = ~shapely.is_empty(intersections)
 
-            # filter applies and polygon is a multipolygon
-            if filter_bool and isinstance(
-                intersection, (MultiPolygon, GeometryCollection)
-            ):
-                inter: Union[BaseGeometry, BaseMultipartGeometry]
-                for inter in intersection.geoms:
-                    if isinstance(inter, Polygon):
-                        tile_intersections.append((inter, annotation_class))
-
-            # filter applies and is a polygon
-            elif filter_bool and isinstance(intersection, Polygon):
-                tile_intersections.append((intersection, annotation_class))
-
-        return tile_intersections
+        # split multipolygons and geometry collections, only polygons are kept
+        parts: NDArray[np.object_]
+        part_index: NDArray[np.intp]
+        parts, part_index = shapely.get_parts(
+            intersections[not_empty], return_index=True
+        )
+        is_polygon: NDArray[np.bool_] = (
+            shapely.get_type_id(parts) == shapely.GeometryType.POLYGON
+        )
+        polygon_index: NDArray[np.intp] = part_index[is_polygon]
+        return (
+            parts[is_polygon],
+            near_poly_classes[not_empty][polygon_index],
+            near_index[not_empty][polygon_index],
+        )
 
     def get_tile_annotation_mask(
         self,
@@ -279,6 +532,7 @@ class QuPathTilingProject(QuPathProject):
         size: tuple[int, int],
         *,
         class_filter: Optional[list[Union[int, str]]] = None,
+        backend: Literal["rasterio", "shapely", "cuda", "auto"] = "rasterio",
     ) -> NDArray[np.int32]:
         """Get tile annotations mask between (x,y) and (x + width, y + height)
 
@@ -290,6 +544,14 @@ class QuPathTilingProject(QuPathProject):
             (width, height) for the tile
         class_filter : Optional[list[Union[int, str]]], optional
             list of annotation class names or id's to filter by, by default None
+        backend : Literal["rasterio", "shapely", "cuda", "auto"], optional
+            'rasterio' --> burn polygons with rasterio.features.rasterize \n
+            'shapely' --> test pixel centers with shapely.contains_xy,
+            faster for many small polygons \n
+            'cuda' --> test pixel centers on the GPU, requires cupy \n
+            'auto' --> choose by the polygon sizes, \n
+            pixels on polygon edges may differ between the backends,
+            by default 'rasterio'
 
         Returns
         -------
@@ -297,7 +559,17 @@ class QuPathTilingProject(QuPathProject):
             mask [height, width] with an annotation class for each pixel \n
             or binary_mask[num_class, height, width] for multichannel \n
             background class is ignored for multichannel
+
+        Raises
+        ------
+        ValueError
+            backend is unknown
         """
+        if backend not in ("rasterio", "shapely", "cuda", "auto"):
+            raise ValueError(
+                f"Unknown backend '{backend}', "
+                "use 'rasterio', 'shapely', 'cuda' or 'auto'"
+            )
 
         downsample_factor: float = self.get_downsample_factor(
             mask_params.downsample_level,
@@ -306,12 +578,21 @@ class QuPathTilingProject(QuPathProject):
         )
 
         # level_0_size needed to get all Polygons in downsample area
-        level_0_size: tuple[int, int] = cast(
-            tuple[int, int], tuple(x * downsample_factor for x in size)
+        level_0_size: tuple[float, float] = (
+            size[0] * downsample_factor,
+            size[1] * downsample_factor,
         )
         # get all annotations in tile
-        tile_intersections: list[tuple[Polygon, str]] = self.get_tile_annotation(
-            mask_params.img_id, mask_params.location, level_0_size, class_filter
+        tile_polys: NDArray[np.object_]
+        tile_classes: NDArray[np.object_]
+        tile_index: NDArray[np.intp]
+        # the clipped polygons are only rasterized, so they don't need to be valid
+        tile_polys, tile_classes, tile_index = self._get_tile_intersections(
+            mask_params.img_id,
+            mask_params.location,
+            level_0_size,
+            class_filter,
+            clip_by_rect=True,
         )
 
         # generate NDArray with zeroes where annotation will be drawn
@@ -325,47 +606,84 @@ class QuPathTilingProject(QuPathProject):
             annotation_mask: NDArray[np.int32] = np.zeros(
                 (size[1], size[0]), dtype=np.int32
             )
-            ## sort intersections descending by area.
+            ## sort intersections descending by the filled area of their annotation.
             # Now we can not accidentally overwrite polys with other poly holes
-            sorted_intersections: list[tuple[Polygon, str]] = sorted(
-                tile_intersections,
-                key=lambda tup: Polygon(tup[0].exterior).area,
-                reverse=True,
+            ann_areas: NDArray[np.float64] = self.img_annotation_dict[
+                mask_params.img_id
+            ].areas
+            area_order: NDArray[np.intp] = np.argsort(
+                -ann_areas[tile_index], kind="stable"
             )
-            tile_intersections = sorted_intersections
-
-        ## draw annotations on empty mask (NDArray)
-        inter_class: str
-        intersection: Polygon
-        for intersection, inter_class in tile_intersections:
-            class_num: Optional[int] = self._inverse_class_dict.get(inter_class)
-            if class_num is None:
-                continue
-            # first class should be on the lowest level for multichannel
-            if not mask_params.multichannel:
-                class_num += 1
+            tile_polys = tile_polys[area_order]
+            tile_classes = tile_classes[area_order]
+
+        ## translate classes to class numbers, unknown classes are dropped
+        # first class should be on the lowest level for multichannel
+        class_offset: int = 0 if mask_params.multichannel else 1
+        class_nums: NDArray[np.int32] = self._translate_classes(
+            tile_classes, -1
+        ).astype(np.int32)
+        known: NDArray[np.bool_] = class_nums >= 0
+        known_polys: NDArray[np.object_] = tile_polys[known]
+        tile_class_nums: NDArray[np.int32] = class_nums[known] + class_offset
+
+        ## translate Polygons to (0,0) and apply downsampling by scaling them down
+        # all coordinates are transformed at once
+        location_offset: NDArray[np.float64] = np.array(
+            mask_params.location, dtype=np.float64
+        )
+        scale_factor: float = 1 / downsample_factor
+        scaled_polys: NDArray[np.object_] = shapely.transform(
+            known_polys,
+            lambda coords: (coords - location_offset) * scale_factor,
+        )
 
-            # translate Polygon to (0,0)
-            trans_inter: Polygon = affinity.translate(
-                intersection, mask_params.location[0] * -1, mask_params.location[1] * -1
+        if backend == "auto":
+            # point tests only cover the bounds of each polygon, rasterize has a
+            # higher cost per polygon but is faster for large polygons
+            scaled_bounds: NDArray[np.float64] = shapely.bounds(scaled_polys)
+            bounds_area: float = np.prod(
+                scaled_bounds[:, 2:] - scaled_bounds[:, :2], axis=1
+            ).sum()
+            backend = (
+                "shapely"
+                if bounds_area < POINT_TEST_MAX_AREA_PER_POLYGON * len(scaled_polys)
+                else "rasterio"
             )
-            # apply downsampling by scaling the Polygon down
-            scale_inter: Polygon = affinity.scale(
-                trans_inter,
-                xfact=1 / downsample_factor,
-                yfact=1 / downsample_factor,
-                origin=(0, 0),  # type: ignore
-                # coords tuple[int, int] are also valid
-                # docu: https://shapely.readthedocs.io/en/stable/manual.html#shapely.affinity.scale
+        if backend == "shapely":
+            self._draw_polygons_contains_xy(
+                annotation_mask,
+                scaled_polys,
+                tile_class_nums,
+                mask_params.multichannel,
             )
-            if mask_params.multichannel:
-                rasterio.features.rasterize(
-                    [(scale_inter, 1)], out=annotation_mask[class_num]
-                )
-            else:
+            return annotation_mask
+        if backend == "cuda":
+            self._draw_polygons_cuda(
+                annotation_mask,
+                scaled_polys,
+                tile_class_nums,
+                mask_params.multichannel,
+            )
+            return annotation_mask
+
+        scaled_intersections: list[tuple[dict[str, Any], int]] = list(
+            zip(self._get_polygon_geojson(scaled_polys), tile_class_nums.tolist())
+        )
+
+        ## draw annotations on empty mask (NDArray)
+        # rasterize burns the shapes in the given order, one call per mask layer
+        if mask_params.multichannel:
+            shapes_by_class: dict[int, list[tuple[dict[str, Any], int]]] = {}
+            for scale_inter, class_num in scaled_intersections:
+                shapes_by_class.setdefault(class_num, []).append((scale_inter, 1))
+            class_shapes: list[tuple[dict[str, Any], int]]
+            for class_num, class_shapes in shapes_by_class.items():
                 rasterio.features.rasterize(
-                    [(scale_inter, class_num)], out=annotation_mask
+                    class_shapes, out=annotation_mask[class_num]
                 )
+        elif scaled_intersections:
+            rasterio.features.rasterize(scaled_intersections, out=annotation_mask)
 
         return annotation_mask
 
@@ -414,24 +732,31 @@ class QuPathTilingProject(QuPathProject):
                     )
                 )
 
+        ## collect detected Polygons and their classes as parallel arrays
+        annotation_polys: list[Polygon] = []
+        annotation_classes: list[int] = []
         annotation_poly_data: dict[str, Any]
         annotation_class: int
-        ## add detected Polygons to the QuPath project
         for annotation_poly_data, annotation_class in poly_annotation_iter:
-            annotation_poly = shape(annotation_poly_data)
-            # scale poly to level 0 (no downsampling) size
-            annotation_poly = affinity.scale(
-                annotation_poly,
-                xfact=1 * downsample_factor,
-                yfact=1 * downsample_factor,
-                origin=(0, 0),  # type: ignore
-            )
-            slide.hierarchy.add_annotation(
-                affinity.translate(
-                    annotation_poly, mask_params.location[0], mask_params.location[1]
-                ),
-                self._class_dict[annotation_class],
-            )
+            annotation_polys.append(shape(annotation_poly_data))
+            annotation_classes.append(annotation_class)
+
+        ## scale polys to level 0 (no downsampling) size and move them to the location
+        # all coordinates are transformed at once
+        location_offset: NDArray[np.float64] = np.array(
+            mask_params.location, dtype=np.float64
+        )
+        level_0_polys: NDArray[np.object_] = shapely.transform(
+            np.array(annotation_polys, dtype=object),
+            lambda coords: coords * downsample_factor + location_offset,
+        )
+
+        ## add detected Polygons to the QuPath project
+        class_dict: dict[int, QuPathPathClass] = self._class_dict
+        add_annotation = slide.hierarchy.add_annotation
+        annotation_poly: Polygon
+        for annotation_poly, annotation_class in zip(level_0_polys, annotation_classes):
+            add_annotation(annotation_poly, class_dict[annotation_class])
 
     def merge_near_annotations(self, img_id: int, max_dist: Union[float, int]) -> None:
         """Merge nearby annotations with equivalent annotation class
@@ -446,84 +771,320 @@ class QuPathTilingProject(QuPathProject):
         hierarchy: QuPathPathObjectHierarchy = self.images[img_id].hierarchy
         annotations: PathObjectProxy[QuPathPathAnnotationObject] = hierarchy.annotations
         self._update_img_annotation_dict(img_id)
-        already_merged: list[int] = []  # save merged indices
-        ann_tree: STRtree
-        class_by_id: dict[int, tuple[int, str]]
-        # unpack img_annotation_dict
-        ann_tree, class_by_id = self.img_annotation_dict[img_id]
+        # annotations in the same order as in img_annotation_dict
+        annotation_list: list[QuPathPathAnnotationObject] = list(annotations)
+        ann_cache: _AnnotationCache = self.img_annotation_dict[img_id]
+        ann_rois: NDArray[np.object_] = ann_cache.geoms
+        ann_classes: NDArray[np.object_] = ann_cache.classes
+
+        ## detect all pairs of annotations up to max_dist apart with one bulk query
+        roi_index: NDArray[np.intp]
+        near_index: NDArray[np.intp]
+        roi_index, near_index = ann_cache.tree.query(
+            ann_rois, predicate="dwithin", distance=max_dist
+        )
+        # only annotations of the same class are merged,
+        # annotations without a class are not merged
+        is_neighbor: NDArray[np.bool_] = (
+            (roi_index != near_index)
+            & (ann_classes[roi_index] == ann_classes[near_index])
+            & (ann_classes[roi_index] != "Unknown")
+        )
+        roi_index = roi_index[is_neighbor]
+        near_index = near_index[is_neighbor]
+
+        ## label clusters of near annotations with their lowest index
+        # propagate the lowest label to all neighbors until nothing changes
+        cluster: NDArray[np.intp] = np.arange(len(ann_rois))
+        while True:
+            joined_cluster: NDArray[np.intp] = cluster.copy()
+            np.minimum.at(joined_cluster, roi_index, cluster[near_index])
+            joined_cluster = joined_cluster[joined_cluster]
+            if np.array_equal(joined_cluster, cluster):
+                break
+            cluster = joined_cluster
+
+        ## merge clusters with more than one annotation
+        # merged annotations are added in the order of their first annotation
+        already_merged: NDArray[np.bool_] = cluster != np.arange(len(ann_rois))
+        already_merged[cluster[already_merged]] = True
+        merged_index: NDArray[np.intp] = np.flatnonzero(already_merged)
+        merged_index = merged_index[np.argsort(cluster[merged_index], kind="stable")]
+        cluster_start: NDArray[np.intp] = np.flatnonzero(
+            np.diff(cluster[merged_index], prepend=-1)
+        )
+        # the buffers of near annotations overlap, so their union is connected
+        ann_buffered: NDArray[np.object_] = np.empty(len(ann_rois), dtype=object)
+        ann_buffered[merged_index] = shapely.buffer(
+            ann_rois[merged_index],
+            max_dist,
+            quad_segs=16,  # same as BaseGeometry.buffer
+        )
+        merged_polys: NDArray[np.object_] = shapely.buffer(
+            np.array(
+                [
+                    shapely.union_all(ann_buffered[cluster_index])
+                    for cluster_index in np.split(merged_index, cluster_start)[1:]
+                ],
+                dtype=object,
+            ),
+            -max_dist,
+            quad_segs=16,
+        )
 
+        ## save merged annotations and discard the merged ones
+        merged_annotation: BaseGeometry
+        merged_class: str
+        for merged_annotation, merged_class in zip(
+            merged_polys, ann_classes[merged_index[cluster_start]]
+        ):
+            hierarchy.add_annotation(
+                merged_annotation,
+                self._class_dict[self._inverse_class_dict[merged_class]],
+            )
         index: int
-        annotation: QuPathPathAnnotationObject
-        ## loop trough all annotations and merge fitting annotations
-        for index, annotation in enumerate(annotations):
-            # skip and delete annotation if the annotation is already merged
-            if index in already_merged:
-                annotations.discard(annotation)
+        for index in merged_index.tolist():
+            annotations.discard(annotation_list[index])
+
+    def _draw_polygons_contains_xy(
+        self,
+        annotation_mask: NDArray[np.int32],
+        polygons: NDArray[np.object_],
+        class_nums: NDArray[np.int32],
+        multichannel: bool,
+    ) -> None:
+        """Draw polygons on a mask by testing which pixel centers they contain
+
+        Only the pixels inside the bounds of a polygon are tested.
+
+        Parameters
+        ----------
+        annotation_mask : NDArray[np.int32]
+            Mask [height, width] or [num_class, height, width] to draw on
+        polygons : NDArray[np.object_]
+            Polygons in pixel coordinates of the mask, in drawing order
+        class_nums : NDArray[np.int32]
+            Class number of each polygon
+        multichannel : bool
+            True: set the pixels of the class layer to 1
+            False: set the pixels to the class number
+        """
+        height: int
+        width: int
+        height, width = annotation_mask.shape[-2:]
+        shapely.prepare(polygons)
+        # pixel windows (x_0, y_0, x_1, y_1) around the polygon bounds
+        bounds: NDArray[np.float64] = shapely.bounds(polygons)
+        windows: NDArray[np.int_] = np.clip(
+            np.hstack((np.floor(bounds[:, :2]), np.ceil(bounds[:, 2:]))),
+            0,
+            (width, height, width, height),
+        ).astype(int)
+
+        for polygon, class_num, (x_0, y_0, x_1, y_1) in zip(
+            polygons, class_nums.tolist(), windows.tolist()
+        ):
+            if x_0 >= x_1 or y_0 >= y_1:
                 continue
-            annotation_poly: BaseGeometry = annotation.roi
-            annotation_poly_class: str = (
-                annotation.path_class.id if annotation.path_class else "Undefined"
+            inside: NDArray[np.bool_] = shapely.contains_xy(
+                polygon,
+                np.arange(x_0, x_1)[np.newaxis, :] + 0.5,
+                np.arange(y_0, y_1)[:, np.newaxis] + 0.5,
             )
-            annotation_poly_buffered: BaseGeometry = annotation_poly.buffer(max_dist)
-
-            # save annotation to merge (initial: current annotation of the loop)
-            annotations_to_merge: list[BaseGeometry] = [annotation_poly_buffered]
-
-            ## detect possible merges between more then two Polygons
-            ## first query current Polygon and then Polygons with intersections
-            # nested annotations holds all annotations to check for further neighbors
-            nested_annotations: list[BaseGeometry] = [annotation_poly_buffered]
-            while len(nested_annotations) > 0:
-                annotation_poly_buffered = nested_annotations.pop(0)
-                near_polys: Iterable[BaseGeometry] = ann_tree.geometries.take(
-                    ann_tree.query(annotation_poly_buffered)
-                )
-                near_poly_index_and_classes: list[tuple[int, str]] = [
-                    class_by_id[id(poly)] for poly in near_polys
-                ]
-
-                # check if nearby polygons are detected
-                if len(near_polys) == 0:
-                    continue
-                near_poly: BaseGeometry
-                near_poly_index: int
-                near_poly_annotation_class: str
-                ## save nearby polygons if they intersect with current polygon
-                for near_poly, (near_poly_index, near_poly_annotation_class) in zip(
-                    near_polys, near_poly_index_and_classes
-                ):
-                    # detected Polygon is already merged
-                    # -> no further checks needed
-                    if near_poly_index in already_merged:
-                        continue
-                    # tree query will always return the polygon from the same annotation
-                    if index == near_poly_index:
-                        continue
-                    # compare Polygon classes
-                    if annotation_poly_class != near_poly_annotation_class:
-                        continue
-
-                    # check if nearby polygon intersects
-                    near_poly_buffered: BaseGeometry = near_poly.buffer(max_dist)
-                    intersects: bool = near_poly_buffered.intersects(
-                        annotation_poly_buffered
-                    )
-                    if intersects:
-                        annotations_to_merge.append(near_poly_buffered)
-                        nested_annotations.append(near_poly_buffered)
-                        already_merged.append(near_poly_index)
-
-            ## merge and save annotations
-            # discard merged annotations
-            if len(annotations_to_merge) > 1:
-                merged_annotation: BaseGeometry = unary_union(
-                    annotations_to_merge
-                ).buffer(-max_dist)
-                hierarchy.add_annotation(
-                    merged_annotation,
-                    self._class_dict[self._inverse_class_dict[annotation_poly_class]],
-                )
-                annotations.discard(annotation)
+            if multichannel:
+                annotation_mask[class_num, y_0:y_1, x_0:x_1][inside] = 1
+            else:
+                annotation_mask[y_0:y_1, x_0:x_1][inside] = class_num
+
+    def _flatten_polygons(
+        self, polygons: NDArray[np.object_]
+    ) -> tuple[NDArray[np.float64], NDArray[np.intp], NDArray[np.intp]]:
+        """Get the ring coordinates of all polygons as one array
+
+        Parameters
+        ----------
+        polygons : NDArray[np.object_]
+            Polygons to flatten
+
+        Returns
+        -------
+        tuple[NDArray[np.float64], NDArray[np.intp], NDArray[np.intp]]
+            coordinates [num_coords, 2] of all rings (exterior first),
+            start index of each ring in the coordinates (+ end index)
+            and start index of each polygon in the rings (+ end index)
+        """
+        rings: NDArray[np.object_]
+        ring_poly_index: NDArray[np.intp]
+        rings, ring_poly_index = shapely.get_rings(polygons, return_index=True)
+        coords: NDArray[np.float64]
+        coord_ring_index: NDArray[np.intp]
+        coords, coord_ring_index = shapely.get_coordinates(rings, return_index=True)
+        ring_offsets: NDArray[np.intp] = np.searchsorted(
+            coord_ring_index, np.arange(len(rings) + 1)
+        )
+        polygon_offsets: NDArray[np.intp] = np.searchsorted(
+            ring_poly_index, np.arange(len(polygons) + 1)
+        )
+        return coords, ring_offsets, polygon_offsets
+
+    def _get_polygon_geojson(
+        self, polygons: NDArray[np.object_]
+    ) -> list[dict[str, Any]]:
+        """Build GeoJSON-like polygon mappings for rasterization
+
+        The rings are passed as float64 coordinate arrays taken from one
+        shapely.get_coordinates call, instead of the per-vertex tuples
+        generated by the __geo_interface__ of each Polygon.
+
+        Parameters
+        ----------
+        polygons : NDArray[np.object_]
+            Polygons to convert
+
+        Returns
+        -------
+        list[dict[str, Any]]
+            GeoJSON-like polygon mapping for each polygon
+        """
+        coords: NDArray[np.float64]
+        ring_offsets: NDArray[np.intp]
+        polygon_offsets: NDArray[np.intp]
+        coords, ring_offsets, polygon_offsets = self._flatten_polygons(polygons)
+        # split coordinates into rings and rings into polygons
+        ring_coords: list[NDArray[np.float64]] = np.split(coords, ring_offsets[1:-1])
+        return [
+            {"type": "Polygon", "coordinates": ring_coords[start:end]}
+            for start, end in zip(polygon_offsets[:-1], polygon_offsets[1:])
+        ]
+
+    def _draw_polygons_cuda(
+        self,
+        annotation_mask: NDArray[np.int32],
+        polygons: NDArray[np.object_],
+        class_nums: NDArray[np.int32],
+        multichannel: bool,
+    ) -> None:
+        """Draw polygons on a mask with one CUDA kernel launch
+
+        Each GPU thread tests one pixel center against all polygons in
+        drawing order (even-odd rule), so later polygons overwrite earlier ones.
+
+        Parameters
+        ----------
+        annotation_mask : NDArray[np.int32]
+            Mask [height, width] or [num_class, height, width] to draw on
+        polygons : NDArray[np.object_]
+            Polygons in pixel coordinates of the mask, in drawing order
+        class_nums : NDArray[np.int32]
+            Class number of each polygon
+        multichannel : bool
+            True: set the pixels of the class layer to 1
+            False: set the pixels to the class number
+
+        Raises
+        ------
+        IndexError
+            a class number has no layer in the multichannel mask
+        ImportError
+            cupy is required for the cuda backend
+        """
+        class_array: NDArray[np.int32] = np.asarray(class_nums, dtype=np.int32)
+        # the kernel does not check the layer index, so it would write past the mask
+        max_class_num: int = int(class_array.max(initial=-1))
+        if multichannel and max_class_num >= annotation_mask.shape[0]:
+            raise IndexError(
+                f"index {max_class_num} is out of bounds for axis 0 "
+                f"with size {annotation_mask.shape[0]}"
+            )
+
+        try:
+            import cupy  # pylint: disable=import-outside-toplevel
+        except ImportError as exc:
+            raise ImportError(
+                "The 'cuda' backend requires cupy: pip install gin-moth[cuda]"
+            ) from exc
+
+        global _FILL_POLYGONS_KERNEL  # pylint: disable=global-statement
+        if _FILL_POLYGONS_KERNEL is None:
+            _FILL_POLYGONS_KERNEL = cupy.RawKernel(
+                FILL_POLYGONS_CUDA_SOURCE, "fill_polygons"
+            )
+
+        height: int
+        width: int
+        height, width = annotation_mask.shape[-2:]
+        coords: NDArray[np.float64]
+        ring_offsets: NDArray[np.intp]
+        polygon_offsets: NDArray[np.intp]
+        coords, ring_offsets, polygon_offsets = self._flatten_polygons(polygons)
+        # multichannel: draw 1 on the class layer, else: draw class on layer 0
+        layers: NDArray[np.int32] = (
+            class_array if multichannel else np.zeros_like(class_array)
+        )
+        values: NDArray[np.int32] = (
+            np.ones_like(class_array) if multichannel else class_array
+        )
+
+        gpu_mask = cupy.asarray(annotation_mask)
+        threads_per_block: int = 256
+        num_pixels: int = height * width
+        _FILL_POLYGONS_KERNEL(
+            ((num_pixels + threads_per_block - 1) // threads_per_block,),
+            (threads_per_block,),
+            (
+                cupy.asarray(coords, dtype=cupy.float64),
+                cupy.asarray(ring_offsets, dtype=cupy.int32),
+                cupy.asarray(polygon_offsets, dtype=cupy.int32),
+                cupy.asarray(shapely.bounds(polygons), dtype=cupy.float64),
+                cupy.asarray(layers),
+                cupy.asarray(values),
+                np.int32(len(polygons)),
+                np.int32(height),
+                np.int32(width),
+                gpu_mask,
+            ),
+        )
+        annotation_mask[...] = gpu_mask.get()
+
+    def _get_slide(self, img_id: int) -> TiffSlide:
+        """Get the opened slide of an image, the slide is only opened on first use
+        and reopened in forked processes
+
+        At most MAX_OPEN_SLIDES slides are kept open,
+        the least recently used slide is closed first
+
+        Parameters
+        ----------
+        img_id : int
+            Id of the image
+
+        Returns
+        -------
+        TiffSlide
+            opened slide
+        """
+        if self._slide_handles_pid != os.getpid():
+            # handles were inherited from the parent process,
+            # which still uses them, so they are dropped instead of closed
+            self._slide_handles = OrderedDict()
+            self._slide_handles_pid = os.getpid()
+        slide_url: str = self._prepare_image_url(self.images[img_id])
+        cached_slide: Optional[tuple[str, TiffSlide]] = self._slide_handles.get(img_id)
+        if cached_slide is not None:
+            # reopen the slide if the image path was updated
+            if cached_slide[0] == slide_url:
+                self._slide_handles.move_to_end(img_id)
+                return cached_slide[1]
+            cached_slide[1].close()
+            del self._slide_handles[img_id]
+        slide_data: TiffSlide = TiffSlide(slide_url)
+        self._slide_handles[img_id] = (slide_url, slide_data)
+        # close the least recently used slides
+        evicted_slide: TiffSlide
+        while len(self._slide_handles) > MAX_OPEN_SLIDES:
+            _, (_, evicted_slide) = self._slide_handles.popitem(last=False)
+            evicted_slide.close()
+        return slide_data
 
     def _prepare_image_url(self, slide: QuPathProjectImageEntry) -> str:
         """Prepare image url for tiling
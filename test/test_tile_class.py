@@ -4,17 +4,26 @@ import os
 import pickle
 import shutil
 import unittest
+from typing import Literal, Optional, Union
+from unittest import mock
 
 import numpy as np
 from numpy.typing import NDArray
 from paquo.classes import QuPathPathClass
 from paquo.images import QuPathProjectImageEntry
-from shapely.geometry import Polygon
+from paquo.pathobjects import QuPathPathAnnotationObject
+from shapely.geometry import MultiPolygon, Polygon, box
+from shapely.geometry.base import BaseGeometry
 from shapely.strtree import STRtree
 
 import moth
 from moth.projects import MaskParameter, QuPathTilingProject
 
+try:
+    import cupy
+except ImportError:
+    cupy = None
+
 QUPATH_PATH: str = (
     "test/test_projects/qp_project/project.qpproj"  # generated by create_qp_project.ipynb
 )
@@ -102,6 +111,24 @@ class TestTileExport(unittest.TestCase):
         )
         self.assertTrue(np.array_equal(expected_tile, tile_arr))
 
+    def test_get_tile_reuses_slide(self):
+        self.qp_project.get_tile(0, (500, 500), (50, 50))
+        slide_data = self.qp_project._get_slide(0)
+        self.qp_project.get_tile(0, (550, 550), (50, 50))
+        self.assertIs(slide_data, self.qp_project._get_slide(0))
+        self.qp_project.close()
+        self.assertEqual(self.qp_project._slide_handles, {})
+
+    def test_get_tile_reopens_slide_in_new_process(self):
+        self.qp_project.get_tile(0, (500, 500), (50, 50))
+        slide_data = self.qp_project._get_slide(0)
+        # simulate a forked DataLoader worker
+        with mock.patch("moth.projects.os.getpid", return_value=os.getpid() + 1):
+            worker_slide_data = self.qp_project._get_slide(0)
+            self.assertIsNot(slide_data, worker_slide_data)
+            self.assertIs(worker_slide_data, self.qp_project._get_slide(0))
+        slide_data.close()
+
     def test_get_tile_annotation(self):
         # use custom annotation to know how the tiled annotation should look like
         expected_polygons: list[Polygon] = [
@@ -128,8 +155,47 @@ class TestTileExport(unittest.TestCase):
         )
         self.assertTrue(np.array_equal(self.expected_multimask, multi_mask))
 
+    def test_get_tile_annotation_mask_backends(self):
+        backend: Literal["shapely", "auto"]
+        for backend in ("shapely", "auto"):
+            with self.subTest(backend=backend):
+                single_mask: NDArray[np.int_] = (
+                    self.qp_project.get_tile_annotation_mask(
+                        MaskParameter(0, (500, 500), multichannel=False),
+                        (50, 50),
+                        backend=backend,
+                    )
+                )
+                self.assertTrue(np.array_equal(self.expected_singlemask, single_mask))
+                multi_mask: NDArray[np.int_] = self.qp_project.get_tile_annotation_mask(
+                    MaskParameter(0, (500, 500), multichannel=True),
+                    (50, 50),
+                    backend=backend,
+                )
+                self.assertTrue(np.array_equal(self.expected_multimask, multi_mask))
+        with self.assertRaises(ValueError):
+            self.qp_project.get_tile_annotation_mask(
+                MaskParameter(0, (500, 500)), (50, 50), backend="gpu"  # type: ignore
+            )
+
+    @unittest.skipUnless(cupy, "cupy is not installed")
+    def test_get_tile_annotation_mask_cuda(self):
+        multichannel: bool
+        for multichannel in (False, True):
+            with self.subTest(multichannel=multichannel):
+                mask_params: MaskParameter = MaskParameter(
+                    0, (500, 500), multichannel=multichannel
+                )
+                rasterio_mask: NDArray[np.int_] = (
+                    self.qp_project.get_tile_annotation_mask(mask_params, (50, 50))
+                )
+                cuda_mask: NDArray[np.int_] = self.qp_project.get_tile_annotation_mask(
+                    mask_params, (50, 50), backend="cuda"
+                )
+                self.assertTrue(np.array_equal(rasterio_mask, cuda_mask))
+
     def tearDown(self):
-        pass  # no files created
+        self.qp_project.close()  # no files created
 
 
 class TestTileImport(unittest.TestCase):
@@ -175,10 +241,147 @@ class TestTileImport(unittest.TestCase):
         )
         self.assertTrue(np.array_equal(export_complete_area, export_merged_area))
 
+    def test_get_slide_closes_least_recently_used(self):
+        self.temp_qp_project.add_image(SLIDE_PATH, allow_duplicates=True)
+        self.temp_qp_project.add_image(SLIDE_PATH, allow_duplicates=True)
+        with mock.patch("moth.projects.MAX_OPEN_SLIDES", 2):
+            self.temp_qp_project._get_slide(0)
+            slide_data = self.temp_qp_project._get_slide(1)
+            # use image 0 again, so image 1 is the least recently used
+            self.temp_qp_project._get_slide(0)
+            with mock.patch.object(
+                slide_data, "close", wraps=slide_data.close
+            ) as close_mock:
+                self.temp_qp_project._get_slide(2)
+            close_mock.assert_called_once()
+            self.assertEqual(list(self.temp_qp_project._slide_handles), [0, 2])
+        self.temp_qp_project.close()
+
+    def test_get_tile_annotation_class_filter(self):
+        # class numbers must not match class names which look like numbers
+        path_classes: tuple[QuPathPathClass, ...] = (
+            QuPathPathClass("Background"),
+            QuPathPathClass("A"),
+            QuPathPathClass("1"),
+        )
+        self.temp_qp_project.path_classes = path_classes
+        path_class: QuPathPathClass
+        for path_class in path_classes[1:]:
+            self.temp_qp_project.images[0].hierarchy.add_annotation(
+                Polygon([(10, 10), (40, 10), (40, 40), (10, 40)]), path_class
+            )
+        class_filter: list[Union[int, str]]
+        expected_classes: list[str]
+        for class_filter, expected_classes in (
+            ([1], ["A"]),
+            (["1"], ["1"]),
+            ([2], ["1"]),
+            ([1, "1"], ["A", "1"]),
+        ):
+            tile_intersections: list[tuple[Polygon, str]] = (
+                self.temp_qp_project.get_tile_annotation(
+                    0, (0, 0), (50, 50), class_filter
+                )
+            )
+            self.assertEqual(
+                sorted(annotation_class for _, annotation_class in tile_intersections),
+                sorted(expected_classes),
+            )
+
+    def test_get_tile_annotation_mask_hole(self):
+        # an annotation inside the hole of another annotation must stay on top,
+        # even if the ring around the hole has a smaller area
+        path_classes: tuple[QuPathPathClass, ...] = self.temp_qp_project.path_classes
+        hierarchy = self.temp_qp_project.images[0].hierarchy
+        hierarchy.add_annotation(
+            box(0, 0, 100, 100).difference(box(10, 10, 90, 90)), path_classes[1]
+        )
+        hierarchy.add_annotation(box(0, 0, 70, 70), path_classes[2])
+        mask: NDArray[np.int32] = self.temp_qp_project.get_tile_annotation_mask(
+            MaskParameter(0, (0, 0)), (100, 100)
+        )
+        self.assertEqual(mask[5, 5], 3)
+        self.assertEqual(mask[50, 50], 3)
+        self.assertEqual(mask[95, 95], 2)
+        self.assertEqual(mask[80, 80], 0)
+
     def test_merge_near_annotations(self):
         # compare merged annotations to original annotations
         # no downsample!
-        pass
+        path_classes: tuple[QuPathPathClass, ...] = self.temp_qp_project.path_classes
+        hierarchy = self.temp_qp_project.images[0].hierarchy
+        annotations_to_add: list[tuple[BaseGeometry, Optional[QuPathPathClass]]] = [
+            # chain A-B-C, only neighbors are near each other
+            (box(0, 0, 10, 10), path_classes[1]),
+            # annotations without a class are never merged
+            (box(100, 0, 110, 10), None),
+            # near annotations with different classes are not merged
+            (box(200, 0, 210, 10), path_classes[2]),
+            (box(11.5, 0, 21.5, 10), path_classes[1]),
+            (box(111, 0, 121, 10), None),
+            (box(211, 0, 221, 10), path_classes[3]),
+            (box(23, 0, 33, 10), path_classes[1]),
+            # a multipolygon merges with annotations near one of its parts
+            (
+                MultiPolygon([box(300, 0, 310, 10), box(400, 0, 410, 10)]),
+                path_classes[4],
+            ),
+            (box(411, 0, 421, 10), path_classes[4]),
+        ]
+        annotation_roi: BaseGeometry
+        annotation_class: Optional[QuPathPathClass]
+        for annotation_roi, annotation_class in annotations_to_add:
+            hierarchy.add_annotation(annotation_roi, annotation_class)
+
+        self.temp_qp_project.merge_near_annotations(0, max_dist=2)
+        merged_annotations: list[QuPathPathAnnotationObject] = list(
+            hierarchy.annotations
+        )
+        # unmerged annotations keep their order,
+        # merged annotations follow in the order of their first annotation
+        expected_annotations: list[tuple[Optional[str], tuple[float, ...]]] = [
+            (None, (100, 0, 110, 10)),
+            (path_classes[2].id, (200, 0, 210, 10)),
+            (None, (111, 0, 121, 10)),
+            (path_classes[3].id, (211, 0, 221, 10)),
+            (path_classes[1].id, (0, 0, 33, 10)),
+            (path_classes[4].id, (300, 0, 421, 10)),
+        ]
+        self.assertEqual(len(merged_annotations), len(expected_annotations))
+        merged_annotation: QuPathPathAnnotationObject
+        expected_class: Optional[str]
+        expected_bounds: tuple[float, ...]
+        for merged_annotation, (expected_class, expected_bounds) in zip(
+            merged_annotations, expected_annotations
+        ):
+            self.assertEqual(
+                (
+                    merged_annotation.path_class.id
+                    if merged_annotation.path_class is not None
+                    else None
+                ),
+                expected_class,
+            )
+            self.assertTrue(np.allclose(merged_annotation.roi.bounds, expected_bounds))
+        # the parts of the multipolygon stay apart
+        self.assertEqual(len(merged_annotations[-1].roi.geoms), 2)
+
+    def test_merge_near_annotations_distance(self):
+        # only annotations up to max_dist apart are merged
+        path_class: QuPathPathClass = self.temp_qp_project.path_classes[1]
+        hierarchy = self.temp_qp_project.images[0].hierarchy
+        hierarchy.add_annotation(box(0, 0, 10, 10), path_class)
+        # 1.5 px apart
+        hierarchy.add_annotation(box(11.5, 0, 21.5, 10), path_class)
+        # 3 px apart, the buffers of both annotations would still touch
+        hierarchy.add_annotation(box(24.5, 0, 34.5, 10), path_class)
+        self.temp_qp_project.merge_near_annotations(0, max_dist=2)
+        merged_bounds: list[tuple[float, ...]] = sorted(
+            annotation.roi.bounds for annotation in hierarchy.annotations
+        )
+        self.assertEqual(len(merged_bounds), 2)
+        self.assertTrue(np.allclose(merged_bounds[0], (0, 0, 21.5, 10)))
+        self.assertTrue(np.allclose(merged_bounds[1], (24.5, 0, 34.5, 10)))
 
     def tearDown(self) -> None:
         # cleanup new QuPath project
@@ -223,20 +426,50 @@ class TestTileUtils(unittest.TestCase):
         self.assertEqual(self.qp_project.path_classes, new_path_classes)
         self.assertEqual(self.qp_project._class_dict, class_dict)
 
+    def test_iter_tile_locations_z_order(self):
+        tile_locations: list[tuple[int, int]] = list(
+            self.qp_project.iter_tile_locations_z_order(
+                self.white_image_id, (1024, 1024)
+            )
+        )
+        expected_locations: set[tuple[int, int]] = {
+            (x, y)
+            for x in range(0, self.white_image.width, 1024)
+            for y in range(0, self.white_image.height, 1024)
+        }
+        self.assertEqual(len(tile_locations), len(expected_locations))
+        self.assertEqual(set(tile_locations), expected_locations)
+        # the first four tiles form the top left square
+        self.assertEqual(
+            tile_locations[:4], [(0, 0), (1024, 0), (0, 1024), (1024, 1024)]
+        )
+
+    def test_draw_polygons_cuda_checks_layers(self):
+        # the kernel can not detect a missing layer, so it is checked beforehand
+        annotation_mask: NDArray[np.int32] = np.zeros((2, 10, 10), dtype=np.int32)
+        polygons: NDArray[np.object_] = np.array(
+            [Polygon([(1, 1), (5, 1), (5, 5), (1, 5)])], dtype=object
+        )
+        with self.assertRaises(IndexError):
+            self.qp_project._draw_polygons_cuda(
+                annotation_mask, polygons, np.array([2], dtype=np.int32), True
+            )
+
     def test_update_img_annotation_dict(self):
         # use own random annotations
         self.assertEqual(self.qp_project.img_annotation_dict, {})
         self.qp_project._update_img_annotation_dict(self.white_image_id)
-        search_tree: STRtree
-        search_tree_dict: dict[int, tuple[int, str]]
-        search_tree, search_tree_dict = self.qp_project.img_annotation_dict[
-            self.white_image_id
-        ]
-        self.assertIsInstance(search_tree, STRtree)
+        annotation_cache = self.qp_project.img_annotation_dict[self.white_image_id]
+        search_tree_rois: NDArray[np.object_] = annotation_cache.geoms
+        search_tree_classes: NDArray[np.object_] = annotation_cache.classes
+        search_tree_areas: NDArray[np.float64] = annotation_cache.areas
+        self.assertIsInstance(annotation_cache.tree, STRtree)
         self.assertEqual(
-            len(search_tree_dict),
+            len(search_tree_classes),
             len(self.qp_project.images[self.white_image_id].hierarchy),
         )
+        self.assertEqual(len(search_tree_rois), len(search_tree_classes))
+        self.assertEqual(len(search_tree_areas), len(search_tree_classes))
 
     def tearDown(self):
         self.qp_project.path_classes = self.original_path_classes